@@ -15,14 +15,17 @@
 
 from __future__ import absolute_import
 
+import os
+import copy
+import json
+import hashlib
+import functools
+
+from oslo_config import cfg
 from stevedore.extension import ExtensionManager
 
 from st2common import log as logging
-from st2common.exceptions.db import StackStormDBObjectNotFoundError
-from st2common.models.api.action import RunnerTypeAPI
-from st2common.persistence.runner import RunnerType
 from st2common.constants.runners import RUNNERS_NAMESPACE
-from st2common.util.action_db import get_runnertype_by_name
 
 __all__ = [
     "register_runner_types",
@@ -31,86 +34,376 @@ __all__ = [
 
 LOG = logging.getLogger(__name__)
 
+# Size of the green thread pool used when the one-by-one fallback writes are dispatched in
+# parallel (runner_registration.parallel = True)
+_REGISTRATION_POOL_SIZE = 8
+
+# Registration keys for runner metadata which has already been successfully registered by this
+# process. Allows repeated invocations in the same process lifetime to short circuit.
+_REGISTERED_MARKER_KEYS = set()
+
+# RunnerType model prototypes keyed on the hash of the payload they were built from. The
+# payloads are static metadata shipped with the runner packages, so the API object
+# construction, schema validation and model transform only need to happen once per unique
+# payload in a process - subsequent registrations copy the cached prototype. Keying on the
+# payload hash means any change to a payload always results in a full rebuild.
+_RUNNER_TYPE_MODELS = {}
+
+
+def _hash_runner_payload(payload):
+    """
+    Return a stable hash for the provided JSON serializable payload.
+
+    :rtype: ``str``
+    """
+    serialized = json.dumps(payload, sort_keys=True)
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _get_runner_type_model(runner_payload, payload_hash):
+    """
+    Return a RunnerType model for the provided payload, re-using a cached prototype when an
+    identical payload has already been processed by this process.
+
+    Construction, schema validation and the model transform all walk the same structural
+    payload, so on a repeated registration the cached prototype cuts the work down to a copy.
+    A deep copy is returned since mongoengine documents share their internal data dict on a
+    shallow copy and the caller mutates the id and content_hash fields on the result.
+
+    :rtype: :class:`RunnerTypeDB`
+    """
+    # Late import to avoid a very expensive import chain when the models are not needed
+    from st2common.models.api.action import RunnerTypeAPI
+
+    runner_type_model = _RUNNER_TYPE_MODELS.get(payload_hash, None)
+
+    if runner_type_model is None:
+        runner_type_api = RunnerTypeAPI(**runner_payload)
+        runner_type_api.validate()
+
+        runner_type_model = RunnerTypeAPI.to_model(runner_type_api)
+        _RUNNER_TYPE_MODELS[payload_hash] = runner_type_model
+
+    return copy.deepcopy(runner_type_model)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_runner_extension_manager():
+    """
+    Return an ExtensionManager for the runners namespace.
+
+    Scanning the entry points is relatively expensive and the set of available runners can't
+    change during the process lifetime so the manager is only built once per process.
+    """
+    # NOTE: We use ExtensionManager directly instead of DriverManager per extension since that is
+    # much faster and allows us to reduce stevedore loading overhead for each runner
+    return ExtensionManager(namespace=RUNNERS_NAMESPACE, invoke_on_load=False)
+
+
+def _get_registration_marker_path():
+    return cfg.CONF.runner_registration.marker_file
+
+
+def _is_registration_cached(registration_key):
+    """
+    Return True if runner metadata with the provided registration key has already been
+    registered - either by this process or, based on the marker file, by an earlier process in
+    the same deploy.
+    """
+    if registration_key in _REGISTERED_MARKER_KEYS:
+        return True
+
+    try:
+        with open(_get_registration_marker_path(), "r") as fp:
+            return fp.read().strip() == registration_key
+    except IOError:
+        return False
+
+
+def _cache_registration(registration_key):
+    """
+    Record a successful registration in the process local cache and the marker file.
+    """
+    _REGISTERED_MARKER_KEYS.add(registration_key)
+
+    marker_path = _get_registration_marker_path()
+    temporary_path = marker_path + ".tmp"
 
-def register_runners(experimental=False, fail_on_failure=True):
+    try:
+        marker_directory = os.path.dirname(marker_path)
+        if marker_directory:
+            os.makedirs(marker_directory, exist_ok=True)
+
+        with open(temporary_path, "w") as fp:
+            fp.write(registration_key)
+
+        # Atomic rename so a concurrent reader never observes a partially written marker
+        os.rename(temporary_path, marker_path)
+    except (IOError, OSError):
+        # Not being able to write the marker (e.g. read-only filesystem) only costs us the
+        # fast path on the next invocation so it's not treated as fatal
+        LOG.debug(
+            "Unable to write runner registration marker file %s",
+            marker_path,
+            exc_info=True,
+        )
+
+
+def register_runners(experimental=False, fail_on_failure=True, force=False):
     """
     Register runners
+
+    :param force: True to always register the runners, even when an earlier invocation with
+                  identical metadata already did.
+    :type force: ``bool``
     """
+    # Late import to avoid pulling in the models and the persistence layer (and with them
+    # mongoengine and jsonschema) for callers which import this module transitively but never
+    # register anything.
+    from st2common.persistence.runner import RunnerType
+
     LOG.debug("Start : register runners")
     runner_count = 0
 
-    manager = ExtensionManager(namespace=RUNNERS_NAMESPACE, invoke_on_load=False)
+    manager = _get_runner_extension_manager()
+
+    runner_metadata_list = []
+    runner_names = []
 
-    # NOTE: We use ExtensionManager directly instead of DriverManager per extension since that is
-    # much faster and allows us to reduce stevedore loading overhead for each runner
     for extension in manager.extensions:
         name = extension.name
         LOG.debug('Found runner "%s"' % (name))
         runner_metadata = extension.plugin.get_metadata()
-        runner_count += register_runner(runner_metadata, experimental)
+        runner_metadata_list.append(runner_metadata)
+
+        if runner_metadata.get("experimental", False) and not experimental:
+            continue
+
+        runner_names += [runner_metadata["name"]] + runner_metadata.get("aliases", [])
+
+    registration_key = _hash_runner_payload([runner_metadata_list, experimental])
+
+    if not force and _is_registration_cached(registration_key):
+        # The marker can outlive the database content (e.g. the database was dropped or a
+        # document was deleted by the user since the marker was written) so the fast path is
+        # guarded by a single cheap count query which verifies every document is present.
+        if RunnerType.count(name__in=runner_names) == len(set(runner_names)):
+            LOG.debug("Runner registration result is cached, skipping registration.")
+            return len(runner_metadata_list)
+
+    # NOTE: We retrieve all the existing runner types with a single query instead of issuing one
+    # query per runner name inside the loop. This way bootstrap only results in a single database
+    # round trip for the existence check instead of N round trips.
+    existing_runner_types = {
+        runner_type_db.name: runner_type_db
+        for runner_type_db in RunnerType.query(name__in=runner_names)
+    }
+
+    runner_type_models = []
+
+    for runner_metadata in runner_metadata_list:
+        runner_type_models += _create_runner_type_models(
+            runner_metadata, experimental, existing_runner_types
+        )
+        runner_count += 1
+
+    all_persisted = _persist_runner_type_models(runner_type_models)
+
+    # Only record the registration as done when every model persisted - a partial failure
+    # needs to be retried by the next bootstrap.
+    if all_persisted:
+        _cache_registration(registration_key)
 
     LOG.debug("End : register runners")
 
     return runner_count
 
 
-def register_runner(runner_type, experimental):
+def register_runner(runner_type, experimental, existing_runner_types=None):
+    runner_type_models = _create_runner_type_models(
+        runner_type=runner_type,
+        experimental=experimental,
+        existing_runner_types=existing_runner_types,
+    )
+    _persist_runner_type_models(runner_type_models)
+    return 1
+
+
+def _create_runner_type_models(runner_type, experimental, existing_runner_types=None):
+    """
+    Build RunnerType models for the provided runner metadata dict.
+
+    :return: ``list`` of ``(runner_type_model, update)`` tuples.
+    """
+    # Late import to avoid a very expensive import chain when the models are not needed
+    from st2common.persistence.runner import RunnerType
+
+    # The experimental flag applies to the runner as a whole so it only needs to be checked
+    # once instead of once per name.
+    if runner_type.get("experimental", False) and not experimental:
+        LOG.debug('Skipping experimental runner "%s"' % (runner_type["name"]))
+        return []
+
     # For backward compatibility reasons, we also register runners under the old names
     runner_names = [runner_type["name"]] + runner_type.get("aliases", [])
-    for runner_name in runner_names:
-        runner_type["name"] = runner_name
-        runner_experimental = runner_type.get("experimental", False)
 
-        if runner_experimental and not experimental:
-            LOG.debug('Skipping experimental runner "%s"' % (runner_name))
-            continue
+    if existing_runner_types is None:
+        existing_runner_types = {
+            runner_type_db.name: runner_type_db
+            for runner_type_db in RunnerType.query(name__in=runner_names)
+        }
 
-        # Remove additional, non db-model attributes
-        non_db_attributes = ["experimental", "aliases"]
-        for attribute in non_db_attributes:
-            if attribute in runner_type:
-                del runner_type[attribute]
+    runner_type_models = []
 
-        try:
-            runner_type_db = get_runnertype_by_name(runner_name)
-            update = True
-        except StackStormDBObjectNotFoundError:
-            runner_type_db = None
-            update = False
+    # Additional attributes from the metadata file which don't exist on the db model
+    non_db_attributes = ["experimental", "aliases"]
+
+    for runner_name in runner_names:
+        # NOTE: We build a new payload for each name instead of mutating the provided metadata
+        # dict in place. This way the caller's dict (which may be shared and re-used on
+        # subsequent calls) is left untouched.
+        runner_payload = {
+            key: value
+            for key, value in runner_type.items()
+            if key not in non_db_attributes
+        }
+        runner_payload["name"] = runner_name
+
+        runner_type_db = existing_runner_types.get(runner_name, None)
+        update = runner_type_db is not None
 
         # Note: We don't want to overwrite "enabled" attribute which is already in the database
         # (aka we don't want to re-enable runner which has been disabled by the user)
-        if runner_type_db and runner_type_db["enabled"] != runner_type["enabled"]:
-            runner_type["enabled"] = runner_type_db["enabled"]
+        if runner_type_db and runner_type_db["enabled"] != runner_payload["enabled"]:
+            runner_payload["enabled"] = runner_type_db["enabled"]
 
         # If package is not provided, assume it's the same as module name for backward
         # compatibility reasons
-        if not runner_type.get("runner_package", None):
-            runner_type["runner_package"] = runner_type["runner_module"]
+        if not runner_payload.get("runner_package", None):
+            runner_payload["runner_package"] = runner_payload["runner_module"]
 
-        runner_type_api = RunnerTypeAPI(**runner_type)
-        runner_type_api.validate()
-        runner_type_model = RunnerTypeAPI.to_model(runner_type_api)
+        payload_hash = _hash_runner_payload(runner_payload)
+
+        # NOTE: On a warm bootstrap the metadata almost never changes so in the common case we
+        # can skip the write (and the corresponding journal and audit traffic) completely.
+        if runner_type_db and runner_type_db.content_hash == payload_hash:
+            LOG.debug(
+                'RunnerType "%s" hasn\'t changed since the last registration, '
+                "skipping write." % (runner_name)
+            )
+            continue
+
+        runner_type_model = _get_runner_type_model(runner_payload, payload_hash)
+        runner_type_model.content_hash = payload_hash
 
         if runner_type_db:
             runner_type_model.id = runner_type_db.id
 
-        try:
-            runner_type_db = RunnerType.add_or_update(runner_type_model)
-
-            extra = {"runner_type_db": runner_type_db}
-            if update:
-                LOG.audit(
-                    "RunnerType updated. RunnerType %s", runner_type_db, extra=extra
-                )
-            else:
-                LOG.audit(
-                    "RunnerType created. RunnerType %s", runner_type_db, extra=extra
-                )
-        except Exception:
-            LOG.exception("Unable to register runner type %s.", runner_type["name"])
-            return 0
-    return 1
+        runner_type_models.append((runner_type_model, update))
+
+    return runner_type_models
+
+
+def _persist_runner_type_models(runner_type_models):
+    """
+    Persist the provided RunnerType models using a single bulk upsert operation and fall back
+    to persisting each model on its own if the bulk write fails.
+
+    :param runner_type_models: List of ``(runner_type_model, update)`` tuples.
+
+    :return: True if all the provided models were persisted.
+    :rtype: ``bool``
+    """
+    from pymongo import ReplaceOne
+    from pymongo.errors import BulkWriteError
+
+    from st2common.models.db.runner import RunnerTypeDB
+    from st2common.util import concurrency
+
+    if not runner_type_models:
+        return True
+
+    # NOTE: We upsert all the documents with a single unordered bulk write so registration only
+    # results in a single database round trip and write concern acknowledgment instead of one
+    # per runner type.
+    operations = []
+
+    for runner_type_model, _ in runner_type_models:
+        document = runner_type_model.to_mongo().to_dict()
+        document.pop("_id", None)
+        # NOTE: ReplaceOne and not UpdateOne with $set - add_or_update saves a complete
+        # document so the bulk path needs the same full replace semantics, otherwise fields
+        # removed from the runner metadata would linger in the stored document.
+        operations.append(
+            ReplaceOne({"name": runner_type_model.name}, document, upsert=True)
+        )
+
+    try:
+        RunnerTypeDB._get_collection().bulk_write(operations, ordered=False)
+        persisted = runner_type_models
+    except BulkWriteError:
+        LOG.exception("Bulk registration of runner types failed, retrying one by one.")
+
+        # Fall back to persisting each model on its own so a single bad document doesn't
+        # prevent the remaining runner types from being registered.
+        if cfg.CONF.runner_registration.parallel:
+            # The individual writes are independent and I/O bound on the database round trip
+            # so overlapping them from a small green thread pool collapses N serial round
+            # trips into a few pool-width ones.
+            pool = concurrency.get_green_pool_class()(_REGISTRATION_POOL_SIZE)
+            results = list(pool.imap(_add_or_update_runner_type, runner_type_models))
+        else:
+            results = [_add_or_update_runner_type(item) for item in runner_type_models]
+
+        persisted = [result for result in results if result is not None]
+
+    created = []
+    updated = []
+
+    for runner_type_model, update in persisted:
+        # Keep a per runner type debug record around for troubleshooting
+        LOG.debug(
+            "RunnerType %s. RunnerType %s",
+            "updated" if update else "created",
+            runner_type_model.name,
+        )
+
+        if update:
+            updated.append(runner_type_model.name)
+        else:
+            created.append(runner_type_model.name)
+
+    # NOTE: We emit a single aggregated audit record instead of one per runner type. Audit
+    # handlers frequently perform a synchronous flush or network send per record so the record
+    # count dominates the cost on slow sinks.
+    LOG.audit(
+        "RunnerTypes registered. created=%s, updated=%s",
+        created,
+        updated,
+        extra={"created": created, "updated": updated},
+    )
+
+    return len(persisted) == len(runner_type_models)
+
+
+def _add_or_update_runner_type(runner_type_model_tuple):
+    """
+    Persist a single runner type model.
+
+    :return: The provided ``(runner_type_model, update)`` tuple on success and ``None`` on
+             failure.
+    """
+    from st2common.persistence.runner import RunnerType
+
+    runner_type_model, update = runner_type_model_tuple
+
+    try:
+        RunnerType.add_or_update(runner_type_model)
+    except Exception:
+        LOG.exception("Unable to register runner type %s.", runner_type_model.name)
+        return None
+
+    return (runner_type_model, update)
 
 
 def register_runner_types(experimental=False):
@@ -98,6 +98,23 @@ def register_opts(ignore_errors=False):
 
     do_register_opts(schema_opts, "schema", ignore_errors)
 
+    runner_registration_opts = [
+        cfg.BoolOpt(
+            "parallel",
+            default=False,
+            help="True to dispatch the individual runner type database writes from a green "
+            "thread pool when a bulk write can not be used.",
+        ),
+        cfg.StrOpt(
+            "marker_file",
+            default="/var/run/st2/.runners_registered",
+            help="Location of the marker file used to skip repeated registrations of "
+            "unchanged runner metadata.",
+        ),
+    ]
+
+    do_register_opts(runner_registration_opts, "runner_registration", ignore_errors)
+
     system_opts = [
         cfg.BoolOpt("debug", default=False, help="Enable debug mode."),
         cfg.StrOpt(
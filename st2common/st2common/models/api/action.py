@@ -123,6 +123,12 @@ class RunnerTypeAPI(BaseAPI):
                 "additionalProperties": False,
                 "default": {},
             },
+            "content_hash": {
+                "description": "Hash of the runner metadata this runner was "
+                "registered from.",
+                "type": "string",
+                "required": False,
+            },
         },
         "additionalProperties": False,
     }
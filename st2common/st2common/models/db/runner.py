@@ -75,6 +75,13 @@ class RunnerTypeDB(stormbase.StormBaseDB, stormbase.UIDFieldMixin):
         required=False,
         help_text="The python module that implements the query module for this runner.",
     )
+    content_hash = me.StringField(
+        required=False,
+        help_text=(
+            "Hash of the runner metadata this document was registered from. Used to "
+            "skip database writes when the metadata hasn't changed."
+        ),
+    )
 
     meta = {"indexes": stormbase.UIDFieldMixin.get_indexes()}
 
@@ -19,6 +19,7 @@ import os
 import abc
 import shutil
 import tempfile
+import functools
 from subprocess import list2cmdline
 
 import six
@@ -112,10 +113,17 @@ def get_runner_module(name):
     return module
 
 
+@functools.lru_cache(maxsize=None)
 def get_metadata(package_name):
     """
     Return runner related metadata for the provided runner package name.
 
+    The parsed metadata is cached per package. Every runner module in a package reads the same
+    runner.yaml file and many of the parameter schemas it contains are duplicated verbatim
+    across the runner definitions, so caching means those structures are only parsed and
+    allocated once per process and shared by all the consumers. Callers must treat the returned
+    value as read-only.
+
     :rtype: ``list`` of ``dict``
     """
     import pkg_resources
@@ -0,0 +1,214 @@
+# Copyright 2020 The StackStorm Authors.
+# Copyright 2019 Extreme Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import os
+import copy
+import tempfile
+
+import mock
+from oslo_config import cfg
+from pymongo.errors import BulkWriteError
+
+from st2common.bootstrap import runnersregistrar
+from st2common.models.db.runner import RunnerTypeDB
+from st2common.persistence.runner import RunnerType
+
+from st2tests.base import CleanDbTestCase
+
+__all__ = ["RunnersRegistrarTestCase"]
+
+
+RUNNER_METADATA = {
+    "name": "test-runner",
+    "aliases": ["test-runner-deprecated"],
+    "description": "Test runner.",
+    "enabled": True,
+    "runner_package": "test_runner",
+    "runner_module": "test_runner",
+    "runner_parameters": {
+        "cmd": {"description": "Command to execute.", "type": "string"}
+    },
+}
+
+
+def _get_mock_extension_manager(runner_metadata):
+    extension = mock.Mock()
+    extension.name = runner_metadata["name"]
+    extension.plugin.get_metadata.return_value = runner_metadata
+
+    manager = mock.Mock()
+    manager.extensions = [extension]
+    return manager
+
+
+class RunnersRegistrarTestCase(CleanDbTestCase):
+    def setUp(self):
+        super(RunnersRegistrarTestCase, self).setUp()
+
+        self.marker_path = os.path.join(tempfile.mkdtemp(), ".runners_registered")
+        cfg.CONF.set_override(
+            name="marker_file", override=self.marker_path, group="runner_registration"
+        )
+        self.addCleanup(
+            cfg.CONF.clear_override, "marker_file", group="runner_registration"
+        )
+
+        # Reset the module level caches so every test starts from a cold state
+        runnersregistrar._REGISTERED_MARKER_KEYS.clear()
+        runnersregistrar._RUNNER_TYPE_MODELS.clear()
+
+    def _register_runners(self, runner_metadata=RUNNER_METADATA, **kwargs):
+        manager = _get_mock_extension_manager(runner_metadata=runner_metadata)
+
+        with mock.patch.object(
+            runnersregistrar, "_get_runner_extension_manager", return_value=manager
+        ):
+            return runnersregistrar.register_runners(**kwargs)
+
+    def test_register_runners(self):
+        self.assertEqual(len(RunnerType.get_all()), 0)
+
+        runner_count = self._register_runners()
+        self.assertEqual(runner_count, 1)
+
+        # The runner is registered under its name and all the aliases
+        runner_type_dbs = {
+            runner_type_db.name: runner_type_db
+            for runner_type_db in RunnerType.get_all()
+        }
+        self.assertEqual(
+            sorted(runner_type_dbs.keys()), ["test-runner", "test-runner-deprecated"]
+        )
+
+        runner_type_db = runner_type_dbs["test-runner"]
+        self.assertEqual(runner_type_db.description, "Test runner.")
+        self.assertEqual(runner_type_db.runner_module, "test_runner")
+        self.assertTrue(runner_type_db.content_hash)
+
+    def test_unchanged_metadata_skips_write(self):
+        self._register_runners()
+
+        with mock.patch.object(
+            runnersregistrar,
+            "_persist_runner_type_models",
+            wraps=runnersregistrar._persist_runner_type_models,
+        ) as persist_mock:
+            self._register_runners(force=True)
+
+        # All the stored documents match the metadata so nothing should be written
+        persist_mock.assert_called_once_with([])
+
+    def test_changed_metadata_rewrites_documents(self):
+        self._register_runners()
+
+        runner_metadata = copy.deepcopy(RUNNER_METADATA)
+        runner_metadata["description"] = "Updated test runner."
+
+        runner_count = self._register_runners(runner_metadata=runner_metadata)
+        self.assertEqual(runner_count, 1)
+
+        runner_type_dbs = RunnerType.get_all()
+        self.assertEqual(len(runner_type_dbs), 2)
+
+        for runner_type_db in runner_type_dbs:
+            self.assertEqual(runner_type_db.description, "Updated test runner.")
+
+    def test_user_disabled_runner_stays_disabled(self):
+        self._register_runners()
+
+        runner_type_db = RunnerType.get_by_name("test-runner")
+        runner_type_db.enabled = False
+        RunnerType.add_or_update(runner_type_db)
+
+        self._register_runners(force=True)
+
+        runner_type_db = RunnerType.get_by_name("test-runner")
+        self.assertFalse(runner_type_db.enabled)
+
+    def test_repeated_registration_is_cached_noop(self):
+        runner_count = self._register_runners()
+        self.assertEqual(runner_count, 1)
+
+        # The marker file records the registration key
+        with open(self.marker_path, "r") as fp:
+            self.assertTrue(fp.read().strip())
+
+        with mock.patch.object(
+            runnersregistrar,
+            "_create_runner_type_models",
+            wraps=runnersregistrar._create_runner_type_models,
+        ) as create_mock:
+            runner_count = self._register_runners()
+
+        self.assertEqual(runner_count, 1)
+        self.assertEqual(create_mock.call_count, 0)
+
+        # force=True bypasses the cached result
+        with mock.patch.object(
+            runnersregistrar,
+            "_create_runner_type_models",
+            wraps=runnersregistrar._create_runner_type_models,
+        ) as create_mock:
+            self._register_runners(force=True)
+
+        self.assertEqual(create_mock.call_count, 1)
+
+    def test_cached_registration_heals_deleted_documents(self):
+        self._register_runners()
+
+        # Simulate a user deleting one of the documents after the marker was written
+        runner_type_db = RunnerType.get_by_name("test-runner-deprecated")
+        RunnerType.delete(runner_type_db)
+        self.assertEqual(len(RunnerType.get_all()), 1)
+
+        self._register_runners()
+
+        self.assertEqual(len(RunnerType.get_all()), 2)
+
+    def test_bulk_write_error_falls_back_to_individual_writes(self):
+        collection = RunnerTypeDB._get_collection()
+
+        with mock.patch.object(
+            collection, "bulk_write", side_effect=BulkWriteError({})
+        ):
+            runner_count = self._register_runners()
+
+        self.assertEqual(runner_count, 1)
+        self.assertEqual(len(RunnerType.get_all()), 2)
+
+    def test_partial_persist_failure_is_not_cached(self):
+        original_add_or_update = RunnerType.add_or_update
+
+        def add_or_update(runner_type_model, *args, **kwargs):
+            if runner_type_model.name == "test-runner-deprecated":
+                raise Exception("Simulated write failure")
+            return original_add_or_update(runner_type_model, *args, **kwargs)
+
+        collection = RunnerTypeDB._get_collection()
+
+        with mock.patch.object(
+            collection, "bulk_write", side_effect=BulkWriteError({})
+        ), mock.patch.object(RunnerType, "add_or_update", side_effect=add_or_update):
+            self._register_runners()
+
+        # A partial failure must not be recorded as a successful registration so the next
+        # bootstrap retries it
+        self.assertFalse(os.path.exists(self.marker_path))
+        self.assertEqual(len(runnersregistrar._REGISTERED_MARKER_KEYS), 0)
+
+        self._register_runners()
+        self.assertEqual(len(RunnerType.get_all()), 2)
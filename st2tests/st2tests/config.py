@@ -16,6 +16,7 @@
 from __future__ import absolute_import
 
 import os
+import tempfile
 
 from oslo_config import cfg, types
 
@@ -104,6 +105,15 @@ def _override_common_opts():
     CONF.set_override(name="mask_secrets", override=True, group="log")
     CONF.set_override(name="stream_output", override=False, group="actionrunner")
 
+    # Make sure the runner registration marker is written to a scratch location and not into
+    # the source tree (system.base_path points to the in-repo fixtures directory in tests)
+    marker_file = os.path.join(
+        tempfile.gettempdir(), "st2-tests-runners-registered-%s" % (os.getpid())
+    )
+    CONF.set_override(
+        name="marker_file", override=marker_file, group="runner_registration"
+    )
+
 
 def _override_api_opts():
     CONF.set_override(